@@ -1,20 +1,27 @@
-import gradio as gr
 import os
-import json
 import subprocess
-import socket
-from pathlib import Path
-from contextlib import closing
-from typing import List, Optional, Tuple
-import re
-import webbrowser
+from typing import Iterator, List, Optional, Tuple
 import logging
+import logging.handlers
+import queue
+import atexit
 import traceback
-from datetime import datetime
 import sys
-import signal
 import time
 import shutil
+import uuid
+import itertools
+import mmap
+from collections import Counter, deque
+
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = lambda o: orjson.dumps(o, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode('utf-8')
+except ImportError:
+    import json
+    _loads = json.loads
+    _dumps = lambda o: json.dumps(o, indent=2, ensure_ascii=False)
 
 # ======================== 初始化设置 ========================
 os.environ['GRADIO_SERVER_NAME'] = '127.0.0.1'
@@ -27,12 +34,21 @@ if os.name == 'nt':
 # ======================== 日志配置 ========================
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 LOG_FILE = os.path.join(BASE_DIR, "assfontsubset_gui.log")
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    encoding='utf-8'
-)
+# 日志通过队列交给后台线程写入文件，避免阻塞请求处理线程；正常退出时由atexit写完剩余日志
+_log_queue = queue.SimpleQueue()
+_file_handler = logging.FileHandler(LOG_FILE, encoding='utf-8')
+_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _file_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+_root_logger = logging.getLogger()
+_root_logger.setLevel(logging.INFO)
+_root_logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+
+# 日志尾部缓存：只读取上次位置之后新增的内容，保留最近1000行
+_log_cache = {"pos": 0, "lines": deque(maxlen=1000), "ino": None}
+LOG_TAIL_BYTES = 1_048_576  # 单次刷新最多读取的日志字节数
+ERROR_LOG_TAIL_LINES = 20  # 执行出错时写入日志的输出行数
 
 # ======================== 配置管理 ========================
 DEFAULT_CONFIG_PATH = os.path.join(BASE_DIR, "config.json")
@@ -49,10 +65,11 @@ DEFAULT_CONFIG = {
     "debug": False,
     "server_port": DEFAULT_PORT
 }
+_DIR_KEYS = {"output_dir", "font_dir", "bin_path"}  # 需要按目录路径处理的配置项
 
 def clean_path(path_str: str) -> str:
     """清理路径字符串，去除多余的引号"""
-    return re.sub(r'^[\'"]|[\'"]$', '', path_str.strip()) if path_str else ""
+    return path_str.strip().strip('\'"') if path_str else ""
 
 def validate_dir_path(path_str: str) -> Tuple[bool, Optional[str]]:
     """验证目录路径是否有效"""
@@ -60,22 +77,23 @@ def validate_dir_path(path_str: str) -> Tuple[bool, Optional[str]]:
     if not path_str:
         return False, "路径不能为空"
     try:
-        path = Path(path_str)
-        if path.is_dir():
-            return True, str(path.resolve())
+        # abspath只做字符串规范化，不像resolve()那样逐级解析符号链接
+        if os.path.isdir(path_str):
+            return True, os.path.abspath(path_str)
         return False, "路径不是有效目录"
     except Exception as e:
         return False, f"路径验证失败: {str(e)}"
 
 def validate_port(port_str: str) -> Tuple[bool, Optional[int]]:
     """验证端口号是否有效"""
-    try:
-        port = int(port_str)
-        if 1024 <= port <= 65535:
-            return True, port
-        return False, None
-    except ValueError:
+    # 先做字符检查，避免无效输入走异常流程；负数本就不在有效范围内
+    port_str = str(port_str).strip()
+    if not (port_str.isascii() and port_str.isdigit()):
         return False, None
+    port = int(port_str)
+    if 1024 <= port <= 65535:
+        return True, port
+    return False, None
 
 def get_port_from_file():
     """从WebUI_Port文件中读取端口号"""
@@ -107,20 +125,20 @@ def save_port_to_file(port):
 
 def generate_default_filename() -> str:
     """生成默认文件名"""
-    return f"assfont_config_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    return f"assfont_config_{time.strftime('%Y%m%d_%H%M%S')}.json"
 
 def load_config(config_path: str = "") -> Tuple[dict, Optional[str]]:
     """加载配置文件"""
     config_path = clean_path(config_path) if config_path else DEFAULT_CONFIG_PATH
     try:
         if os.path.exists(config_path):
-            with open(config_path, 'r', encoding='utf-8') as f:
-                config = json.load(f)
+            with open(config_path, 'rb') as f:
+                config = _loads(f.read())
                 if isinstance(config, dict):
                     valid_config = DEFAULT_CONFIG.copy()
                     for key, value in config.items():
                         if key in valid_config:
-                            if key.endswith(('_dir', '_path', 'output_dir')):
+                            if key in _DIR_KEYS:
                                 # 对于输出目录，允许为空字符串
                                 if key == 'output_dir':
                                     valid_config[key] = value if value is not None else ""
@@ -129,7 +147,12 @@ def load_config(config_path: str = "") -> Tuple[dict, Optional[str]]:
                                     if validated:
                                         valid_config[key] = validated
                             elif key == 'input_paths' and isinstance(value, list):
-                                valid_config[key] = [validate_dir_path(p)[1] for p in value if validate_dir_path(p)[1]]
+                                validated_paths = []
+                                for p in value:
+                                    ok, v = validate_dir_path(p)
+                                    if ok:
+                                        validated_paths.append(v)
+                                valid_config[key] = validated_paths
                             else:
                                 valid_config[key] = value
                     return valid_config, None
@@ -154,8 +177,21 @@ def save_config(save_dir: str, filename: str, config: dict) -> Tuple[bool, Optio
         save_path = os.path.join(validated_dir, filename)
         os.makedirs(validated_dir, exist_ok=True)
         
-        with open(save_path, 'w', encoding='utf-8') as f:
-            json.dump(config, f, indent=2, ensure_ascii=False)
+        # 先序列化，再写入同目录下的临时文件并原子替换，避免留下写了一半的配置文件
+        data = _dumps(config).encode('utf-8')
+        # 临时文件用唯一文件名独占创建，权限与普通open一致（受umask控制）
+        tmp_path = f"{save_path}.{uuid.uuid4().hex}.tmp"
+        f = open(tmp_path, 'xb')
+        try:
+            with f:
+                f.write(data)
+            # 覆盖已有配置时保留其原有权限
+            if os.path.exists(save_path):
+                shutil.copymode(save_path, tmp_path)
+            os.replace(tmp_path, save_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
         
         return True, f"配置已成功保存到: {save_path}"
     except Exception as e:
@@ -163,19 +199,41 @@ def save_config(save_dir: str, filename: str, config: dict) -> Tuple[bool, Optio
         logging.error(error_msg)
         return False, error_msg
 
+def scan_dir_files(paths: List[str]) -> dict:
+    """对包含两个及以上文件的目录各扫描一次，返回 {目录: 文件名集合}
+    
+    Gradio上传的文件各自位于独立的缓存目录，此时逐个stat更便宜，因此单个文件的目录不扫描。
+    """
+    counts = Counter(os.path.dirname(p) for p in paths)
+    dir_files = {}
+    for d, n in counts.items():
+        if n < 2:
+            continue
+        try:
+            with os.scandir(d or '.') as it:
+                dir_files[d] = {e.name for e in it if e.is_file()}
+        except OSError:
+            pass
+    return dir_files
+
 def run_assfontsubset(input_paths: List[str], output_dir: str, font_dir: str, 
                      subset_backend: str, bin_path: str, 
-                     source_han_ellipsis: bool, debug: bool) -> str:
-    """执行 AssFontSubset 命令"""
+                     source_han_ellipsis: bool, debug: bool) -> Iterator[str]:
+    """执行 AssFontSubset 命令，逐行输出执行信息"""
     try:
+        # 先按扩展名筛选，只有候选的ASS文件才需要检查是否存在
+        candidates = [p for p in map(clean_path, input_paths) if os.path.splitext(p)[1].lower() == '.ass']
+        dir_files = scan_dir_files(candidates)
         valid_inputs = []
-        for p in input_paths:
-            p = clean_path(p)
-            if p.lower().endswith('.ass') and os.path.isfile(p):
+        for p in candidates:
+            names = dir_files.get(os.path.dirname(p))
+            # 未扫描的目录、大小写不一致或短文件名等情况回退到os.path.isfile
+            if (names is not None and os.path.basename(p) in names) or os.path.isfile(p):
                 valid_inputs.append(p)
         
         if not valid_inputs:
-            return "错误：没有有效的ASS文件路径"
+            yield "错误：没有有效的ASS文件路径"
+            return
         
         # 处理输出目录 - 如果为空，则使用主程序同目录下的output文件夹
         final_output_dir = output_dir
@@ -186,62 +244,63 @@ def run_assfontsubset(input_paths: List[str], output_dir: str, font_dir: str,
         # 确保输出目录存在
         os.makedirs(final_output_dir, exist_ok=True)
         
-        cmd = ["./AssFontSubset.Console"]
-        cmd.extend(valid_inputs)
-        
-        if final_output_dir:
-            cmd.extend(["--output", final_output_dir])
-        
-        if font_dir:
-            is_valid, validated = validate_dir_path(font_dir)
-            if is_valid:
-                cmd.extend(["--fonts", validated])
-        
-        if subset_backend != "PyFontTools":
-            cmd.extend(["--subset-backend", subset_backend])
+        # 字体目录和pyftsubset目录只验证一次，无效时忽略该参数
+        font_ok, valid_font_dir = validate_dir_path(font_dir) if font_dir else (False, None)
+        bin_ok, valid_bin_path = validate_dir_path(bin_path) if bin_path else (False, None)
         
-        if bin_path and bin_path.strip():
-            is_valid, validated = validate_dir_path(bin_path)
-            if is_valid:
-                cmd.extend(["--bin-path", validated])
-        
-        if not source_han_ellipsis:
-            cmd.append("--no-source-han-ellipsis")
-        
-        if debug:
-            cmd.append("--debug")
+        parts = (
+            (True, ["./AssFontSubset.Console", *valid_inputs]),
+            (bool(final_output_dir), ["--output", final_output_dir]),
+            (font_ok, ["--fonts", valid_font_dir]),
+            (subset_backend != "PyFontTools", ["--subset-backend", subset_backend]),
+            (bin_ok, ["--bin-path", valid_bin_path]),
+            (not source_han_ellipsis, ["--no-source-han-ellipsis"]),
+            (debug, ["--debug"]),
+        )
+        cmd = list(itertools.chain.from_iterable(args for cond, args in parts if cond))
         
-        result = subprocess.run(
-            cmd, 
-            capture_output=True, 
-            text=True, 
+        # 合并stdout/stderr并逐行读取，实时显示执行进度
+        output_lines = []
+        with subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=1,
+            text=True,
             encoding='utf-8',
-            errors='replace',
-            check=True
-        )
+            errors='replace'
+        ) as proc:
+            for line in proc.stdout:
+                output_lines.append(line)
+                yield f"执行中...\n\n输出信息：\n{''.join(output_lines)}"
+            proc.wait()
         
-        output = f"执行成功！\n\n输出信息：\n{result.stdout}"
-        if debug and result.stderr:
-            output += f"\n\n调试信息：\n{result.stderr}"
-        return output
-    except subprocess.CalledProcessError as e:
-        error_msg = f"执行出错：\n\n命令: {' '.join(cmd)}\n错误: {e.stderr}"
-        logging.error(error_msg)
-        return error_msg
+        output = "".join(output_lines)
+        if proc.returncode != 0:
+            # 日志只记录命令、返回码和末尾几行输出，完整输出仅显示在界面上
+            tail = "".join(output_lines[-ERROR_LOG_TAIL_LINES:])
+            logging.error(f"执行出错：命令: {' '.join(cmd)}\n返回码: {proc.returncode}\n输出末尾{ERROR_LOG_TAIL_LINES}行:\n{tail}")
+            yield f"执行出错：\n\n命令: {' '.join(cmd)}\n返回码: {proc.returncode}\n错误: {output}"
+            return
+        
+        yield f"执行成功！\n\n输出信息：\n{output}"
     except FileNotFoundError:
         error_msg = f"找不到AssFontSubset可执行文件: ./AssFontSubset.Console\n请确保AssFontSubset.Console与主程序在同一目录下"
         logging.error(error_msg)
-        return error_msg
+        yield error_msg
     except Exception as e:
         error_msg = f"发生异常：\n\n{str(e)}\n\n{traceback.format_exc()}"
         logging.error(error_msg)
-        return error_msg
+        yield error_msg
 
 def create_ui():
+    # gradio导入较慢，只在真正创建界面时导入
+    import gradio as gr
+    
     initial_port = get_port_from_file() or DEFAULT_PORT
     
     with gr.Blocks(title="AssFontSubset WebUI") as demo:
-        with gr.Tab("主界面"):
+        with gr.Tab("主界面") as main_tab:
             gr.Markdown("# AssFontSubset 字体子集化工具")
             
             with gr.Row():
@@ -295,20 +354,52 @@ def create_ui():
                 with gr.Column():
                     output_log = gr.Textbox(label="执行结果", interactive=False, lines=20)
         
-        with gr.Tab("控制台日志"):
+        with gr.Tab("控制台日志") as log_tab:
             log_display = gr.Textbox(label="日志内容", interactive=False, lines=25, max_lines=1000)
             refresh_btn = gr.Button("刷新日志")
+            # 仅在日志页可见时定时刷新
+            log_timer = gr.Timer(2, active=False)
             
             def update_log_display():
                 try:
                     if os.path.exists(LOG_FILE):
-                        with open(LOG_FILE, 'r', encoding='utf-8') as f:
-                            return f.read()
+                        st = os.stat(LOG_FILE)
+                        # 文件被替换或截断（日志轮转）时重新读取
+                        if st.st_ino != _log_cache["ino"] or st.st_size < _log_cache["pos"]:
+                            _log_cache["ino"] = st.st_ino
+                            _log_cache["pos"] = 0
+                            _log_cache["lines"].clear()
+                        with open(LOG_FILE, 'rb') as f:
+                            size = os.fstat(f.fileno()).st_size
+                            if size - _log_cache["pos"] > LOG_TAIL_BYTES:
+                                # 新增内容过大时通过mmap只取末尾部分，并从完整行开始
+                                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                                    tail_start = size - LOG_TAIL_BYTES
+                                    start = mm.find(b'\n', tail_start) + 1 or tail_start
+                                    data = mm[start:size]
+                                _log_cache["pos"] = start
+                                _log_cache["lines"].clear()
+                            else:
+                                f.seek(_log_cache["pos"])
+                                data = f.read()
+                        # 只消费到最后一个完整行，避免截断多字节字符
+                        end = data.rfind(b'\n') + 1
+                        if end:
+                            _log_cache["lines"].extend(
+                                data[:end].decode('utf-8', errors='replace').splitlines(keepends=True)
+                            )
+                            _log_cache["pos"] += end
+                        return "".join(_log_cache["lines"])
                     return "暂无日志内容"
                 except Exception as e:
                     return f"读取日志失败: {str(e)}"
             
             refresh_btn.click(update_log_display, outputs=log_display)
+            log_timer.tick(update_log_display, outputs=log_display)
+            log_tab.select(lambda: gr.Timer(active=True), outputs=log_timer).then(
+                update_log_display, outputs=log_display
+            )
+            main_tab.select(lambda: gr.Timer(active=False), outputs=log_timer)
         
         def handle_load_config(config_file_obj):
             if not config_file_obj:
@@ -362,9 +453,6 @@ def create_ui():
                 return "请输入有效的端口号", ""
         
         load_config_btn.click(
-            lambda: update_log_display(),
-            outputs=log_display
-        ).then(
             handle_load_config,
             inputs=config_file,
             outputs=[input_files, output_dir, font_dir, subset_backend, bin_path, 
@@ -388,53 +476,47 @@ def create_ui():
             run_assfontsubset,
             inputs=[input_files, output_dir, font_dir, subset_backend, bin_path, source_han_ellipsis, debug],
             outputs=output_log
-        ).then(
-            lambda: update_log_display(),
-            outputs=log_display
         )
         
         return demo
 
 def safe_launch(demo, max_attempts=20):
-    """安全启动Gradio应用"""
+    """安全启动Gradio应用，端口被占用时由Gradio报错后尝试下一个端口"""
+    import threading
+    import webbrowser
+    
     preferred_port = get_port_from_file() or DEFAULT_PORT
     
+    # 保留默认的KeyboardInterrupt处理：Ctrl+C时block_thread关闭服务后正常退出，
+    # atexit中的日志监听线程才能把队列里剩余的日志写入文件
     for attempt in range(max_attempts):
         port = preferred_port + attempt
         try:
             print(f"尝试在端口 {port} 启动...")
             
-            # 检查端口是否可用
-            with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-                s.bind(('127.0.0.1', port))
-            
-            # 设置信号处理
-            signal.signal(signal.SIGINT, signal.SIG_DFL)
-            
-            # 启动应用（去掉share模式）
+            # 启动应用（去掉share模式），直接由Gradio绑定端口，避免预先探测带来的竞争
+            # 先不阻塞主线程，以便端口确定后再打开浏览器
             demo.launch(
                 server_name="127.0.0.1",
                 server_port=port,
                 show_error=True,
-                inbrowser=False
+                inbrowser=False,
+                prevent_thread_lock=True
             )
-            
-            # 保存成功启动的端口
-            save_port_to_file(port)
-            print(f"服务已启动在端口 {port}")
-            webbrowser.open(f"http://127.0.0.1:{port}")
-            return port
-            
         except OSError as e:
-            if "Address already in use" in str(e) or "10048" in str(e):
-                print(f"端口 {port} 已被占用，尝试下一个端口...")
-                continue
-            else:
-                print(f"端口 {port} 启动失败: {e}")
-                continue
+            print(f"端口 {port} 启动失败: {e}，尝试下一个端口...")
+            continue
         except Exception as e:
             print(f"启动过程中发生错误: {e}")
-            continue
+            return None
+        
+        # 保存成功启动的端口
+        save_port_to_file(port)
+        print(f"服务已启动在端口 {port}")
+        # 在后台线程打开浏览器，避免浏览器启动阻塞主线程
+        threading.Thread(target=webbrowser.open, args=(f"http://127.0.0.1:{port}",), daemon=True).start()
+        demo.block_thread()
+        return port
     
     print(f"尝试了 {max_attempts} 个端口后仍然无法启动，请检查网络设置")
     return None